@@ -17,6 +17,8 @@ import os
 import pathlib
 
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
 from google.cloud import storage
 
 
@@ -60,13 +62,12 @@ def obtain_source_data(
     )
     df = pd.read_csv(
         source_data_filepath,
-        engine="python",
+        engine="pyarrow",
         encoding="utf-8",
         quotechar='"',  # string separator, typically double-quotes
         sep=",",  # data column separator, typically ","
     )
-    df = add_key(df, key_list)
-    df.drop_duplicates(subset=["key"], keep="last", inplace=True, ignore_index=False)
+    df.drop_duplicates(subset=key_list, keep="last", inplace=True, ignore_index=False)
 
     return df
 
@@ -77,21 +78,6 @@ def download_file_gs(source_url: str, source_file: pathlib.Path) -> None:
         storage.Client().download_blob_to_file(source_url, file_obj)
 
 
-def add_key(df: pd.DataFrame, key_list: list) -> pd.DataFrame:
-    logging.info(f"Adding key column(s) {key_list}")
-    df["key"] = ""
-    for key in key_list:
-        df["key"] = df.apply(
-            lambda x: str(x[key])
-            if not str(x["key"])
-            else str(x["key"]) + "-" + str(x[key]),
-            axis=1,
-        )
-    df["key_val"] = df["key"]
-
-    return df
-
-
 def reorder_headers(df: pd.DataFrame) -> pd.DataFrame:
     logging.info("Reordering headers..")
     df = df[["country_code", "country_name", "country_area"]]
@@ -101,7 +87,11 @@ def reorder_headers(df: pd.DataFrame) -> pd.DataFrame:
 
 def save_to_new_file(df, file_path, sep="|") -> None:
     logging.info(f"Saving to file {file_path} separator='{sep}'")
-    df.to_csv(file_path, sep=sep, index=False)
+    pacsv.write_csv(
+        pa.Table.from_pandas(df, preserve_index=False),
+        str(file_path),
+        write_options=pacsv.WriteOptions(delimiter=sep),
+    )
 
 
 def upload_file_to_gcs(file_path: pathlib.Path, gcs_bucket: str, gcs_path: str) -> None:
@@ -16,8 +16,12 @@ import logging
 import os
 import pathlib
 
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
 from google.cloud import storage
+from numba import njit
 
 
 def main(
@@ -41,6 +45,7 @@ def main(
     df_country = obtain_source_data(
         source_url, source_file, ["country_code"], "_country_data.csv", 1, ","
     )
+    df_pop, df_country = categorize_country_columns(df_pop, df_country)
 
     df = pd.merge(
         df_pop,
@@ -63,19 +68,85 @@ def main(
     )
 
 
+def categorize_country_columns(df_pop: pd.DataFrame, df_country: pd.DataFrame) -> tuple:
+    logging.info("Converting country columns to categorical")
+    country_code_dtype = pd.CategoricalDtype(
+        pd.concat([df_pop["country_code"], df_country["country_code"]])
+        .dropna()
+        .unique()
+    )
+    df_pop["country_code"] = df_pop["country_code"].astype(country_code_dtype)
+    df_country["country_code"] = df_country["country_code"].astype(country_code_dtype)
+    df_country["country_name"] = df_country["country_name"].astype("category")
+
+    return df_pop, df_country
+
+
+INT64_MAX = np.iinfo(np.int64).max
+
+
+@njit
+def parse_csv_ints(buf: np.ndarray, out: np.ndarray) -> np.ndarray:
+    if buf.size == 0 and out.size == 0:
+        return out
+    position = 0
+    value = 0
+    digits = 0
+    for char in buf:
+        if char == 44:  # ","
+            if digits == 0:
+                raise ValueError("Empty population value")
+            if position >= out.size:
+                raise ValueError("More population values than expected")
+            out[position] = value
+            position += 1
+            value = 0
+            digits = 0
+        elif 48 <= char <= 57:  # "0" - "9"
+            digit = np.int64(char) - 48
+            if value > (INT64_MAX - digit) // 10:
+                raise ValueError("Population value does not fit in int64")
+            value = value * 10 + digit
+            digits += 1
+        else:
+            raise ValueError("Population values must be non-negative integers")
+    if digits == 0:
+        raise ValueError("Empty population value")
+    if position + 1 != out.size:
+        raise ValueError("Population value count does not match row lengths")
+    out[position] = value
+    return out
+
+
 def unpivot_data(df: pd.DataFrame) -> pd.DataFrame:
     logging.info("Unpivoting Data")
-    df["pop_exp"] = df.apply(lambda x: x.population.split(","), axis=1)
-    df_exp_unpivot = df.explode("pop_exp").reset_index().drop(columns="index", axis=1)
-    df_exp_unpivot["age_exp"] = df_exp_unpivot.groupby("key_val_x").cumcount()
-    df_exp_unpivot = df_exp_unpivot.drop(columns=["population", "age"])
+    population = df["population"].astype(str)
+    lens = population.str.count(",").to_numpy() + 1
+    row_starts = lens.cumsum() - lens
+    df_exp_unpivot = df.drop(columns=["population", "age"]).iloc[
+        np.repeat(np.arange(len(df)), lens)
+    ]
+    df_exp_unpivot = df_exp_unpivot.reset_index(drop=True)
+    df_exp_unpivot["year"] = pd.to_numeric(df_exp_unpivot["year"], downcast="integer")
+    df_exp_unpivot["pop_exp"] = pd.to_numeric(
+        parse_csv_ints(
+            np.frombuffer(",".join(population).encode("ascii"), dtype=np.uint8),
+            np.empty(lens.sum(), dtype=np.int64),
+        ),
+        downcast="unsigned",
+    )
+    df_exp_unpivot["age_exp"] = pd.to_numeric(
+        np.arange(lens.sum()) - np.repeat(row_starts, lens), downcast="integer"
+    )
 
     return df_exp_unpivot
 
 
 def resolve_sex(df: pd.DataFrame) -> pd.DataFrame:
     logging.info("Resolving gender data point")
-    df = df.replace(to_replace={"sex": {2: "Male", 3: "Female"}})
+    df["sex"] = (
+        df["sex"].replace({2: "Male", 3: "Female"}).astype("string").astype("category")
+    )
 
     return df
 
@@ -110,13 +181,12 @@ def obtain_source_data(
     )
     df = pd.read_csv(
         source_data_filepath,
-        engine="python",
+        engine="pyarrow",
         encoding="utf-8",
         quotechar='"',  # string separator, typically double-quotes
         sep=",",  # data column separator, typically ","
     )
-    df = add_key(df, key_list)
-    df.drop_duplicates(subset=["key"], keep="last", inplace=True, ignore_index=False)
+    df.drop_duplicates(subset=key_list, keep="last", inplace=True, ignore_index=False)
 
     return df
 
@@ -127,21 +197,6 @@ def download_file_gs(source_url: str, source_file: pathlib.Path) -> None:
         storage.Client().download_blob_to_file(source_url, file_obj)
 
 
-def add_key(df: pd.DataFrame, key_list: list) -> pd.DataFrame:
-    logging.info(f"Adding key column(s) {key_list}")
-    df["key"] = ""
-    for key in key_list:
-        df["key"] = df.apply(
-            lambda x: str(x[key])
-            if not str(x["key"])
-            else str(x["key"]) + "-" + str(x[key]),
-            axis=1,
-        )
-    df["key_val"] = df["key"]
-
-    return df
-
-
 def reorder_headers(df: pd.DataFrame) -> pd.DataFrame:
     logging.info("Reordering headers..")
     df = df[["country_code", "country_name", "year", "sex", "population", "age"]]
@@ -151,7 +206,11 @@ def reorder_headers(df: pd.DataFrame) -> pd.DataFrame:
 
 def save_to_new_file(df, file_path, sep="|") -> None:
     logging.info(f"Saving to file {file_path} separator='{sep}'")
-    df.to_csv(file_path, sep=sep, index=False)
+    pacsv.write_csv(
+        pa.Table.from_pandas(df, preserve_index=False),
+        str(file_path),
+        write_options=pacsv.WriteOptions(delimiter=sep),
+    )
 
 
 def upload_file_to_gcs(file_path: pathlib.Path, gcs_bucket: str, gcs_path: str) -> None:
@@ -11,15 +11,21 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import functools
+import io
 import logging
 import os
 import pathlib
 import shutil
 import subprocess
 import tarfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import pandas as pd
+from google.api_core.exceptions import PreconditionFailed
 from google.cloud import storage
+from google.cloud.storage import transfer_manager
 from retrying import retry
 
 
@@ -64,6 +70,10 @@ def main(
             gcs_bucket=target_gcs_bucket,
             gcs_path=f"{target_gcs_path}/{target_batch_folder}",
         )
+        remove_gcs_path(
+            gcs_bucket=target_gcs_bucket,
+            gcs_path=f"{target_root_path}/{target_batch_folder}/",
+        )
         generate_batch_metadata_files(
             project_id=project_id,
             source_gcs_folder_path=source_url_gcs,
@@ -79,7 +89,6 @@ def main(
             target_gcs_bucket=target_gcs_bucket,
             target_gcs_path=target_gcs_path,
             target_root_path=target_root_path,
-            target_source_folder=target_source_folder,
             target_unpack_folder=target_unpack_folder,
             target_load_folder=target_load_folder,
             target_batch_folder=target_batch_folder,
@@ -97,15 +106,48 @@ def copy_source_files_gcs_to_gcs(
     destination_folder: str,
     file_type: str,
     silent: bool = True,
+    max_workers: int = 8,
 ) -> None:
     logging.info(
         f"Copying from gs://{source_bucket} to gs://{destination_bucket}/{destination_folder}"
     )
-    subprocess.check_call("which gsutil", shell=True)
-    cmd = f"gsutil -m cp -n gs://{source_bucket} gs://{destination_bucket}/{destination_folder}"
-    if silent:
-        cmd += " 2> /dev/null"
-    subprocess.check_call([cmd], shell=True)
+    storage_client = get_storage_client()
+    source = storage_client.bucket(source_bucket)
+    destination = storage_client.bucket(destination_bucket)
+    blobs = source.list_blobs(match_glob=f"**{file_type}" if file_type else None)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(
+                copy_blob_if_missing,
+                source_blob=blob,
+                destination_blob=destination.blob(
+                    f"{destination_folder}/{os.path.basename(blob.name)}"
+                ),
+                silent=silent,
+            )
+            for blob in blobs
+        ]
+        for future in as_completed(futures):
+            if future.exception() is not None:
+                # Don't start the remaining copies; retry reruns them anyway
+                for pending in futures:
+                    pending.cancel()
+                raise future.exception()
+
+
+def copy_blob_if_missing(
+    source_blob: storage.Blob, destination_blob: storage.Blob, silent: bool = True
+) -> None:
+    try:
+        token, _, _ = destination_blob.rewrite(source_blob, if_generation_match=0)
+        while token is not None:
+            token, _, _ = destination_blob.rewrite(
+                source_blob, token=token, if_generation_match=0
+            )
+    except PreconditionFailed:
+        return
+    if not silent:
+        logging.info(f"Copied {source_blob.name} to {destination_blob.name}")
 
 
 def process_batch_metadata_files(
@@ -113,7 +155,6 @@ def process_batch_metadata_files(
     target_gcs_bucket: str,
     target_gcs_path: str,
     target_root_path: str,
-    target_source_folder: str,
     target_unpack_folder: str,
     target_load_folder: str,
     target_batch_folder: str,
@@ -122,12 +163,12 @@ def process_batch_metadata_files(
     batch_ordinal: int,
 ) -> None:
     logging.info("Collecting list of batch metadata files to process ...")
-    storage_client = storage.Client(project_id)
+    storage_client = get_storage_client(project_id)
     bucket_name = target_gcs_bucket
     bucket = storage_client.bucket(bucket_name)
     file_group_ordinal = 1
-    for blob in bucket.list_blobs(prefix=batch_gcs_path):
-        batch_filename = str(blob).split(",")[1].strip()
+    for blob in bucket.list_blobs(prefix=batch_gcs_path, match_glob="**.parquet"):
+        batch_filename = blob.name
         if file_group_ordinal == batch_ordinal:
             process_batch(
                 project_id=project_id,
@@ -135,7 +176,6 @@ def process_batch_metadata_files(
                 target_gcs_bucket=target_gcs_bucket,
                 target_gcs_path=target_gcs_path,
                 target_root_path=target_root_path,
-                target_source_folder=target_source_folder,
                 target_unpack_folder=target_unpack_folder,
                 target_load_folder=target_load_folder,
                 target_batch_folder=target_batch_folder,
@@ -153,7 +193,6 @@ def process_batch(
     target_gcs_bucket: str,
     target_gcs_path: str,
     target_root_path: str,
-    target_source_folder: str,
     target_unpack_folder: str,
     target_load_folder: str,
     target_batch_folder: str,
@@ -167,36 +206,118 @@ def process_batch(
     batch_filename = (
         f"{target_root_path}/{target_batch_folder}/{os.path.basename(batch_filename)}"
     )
-    df_filelist = pd.read_csv(batch_filename, sep="|")
-    for gcs_source_file in df_filelist["pathname"]:
-        filename = os.path.basename(gcs_source_file)
-        guid = str(
-            df_filelist[df_filelist["pathname"] == gcs_source_file]["guid"].values[0]
-        ).strip()
-        source_json_file = f"{target_root_path}/{target_unpack_folder}/{guid}/out.log"
-        destination_json_file = f"{target_root_path}/{target_load_folder}/out{guid}.log"
-        source_tar_file = f"{target_root_path}/{target_source_folder}/{filename}"
-        download_file_gcs(
-            project_id=project_id,
-            source_location=gcs_source_file,
-            destination_folder=f"{target_root_path}/{target_source_folder}",
+    df_filelist = pd.read_parquet(batch_filename)
+    path_to_guid = dict(
+        zip(
+            df_filelist["pathname"].astype(str),
+            df_filelist["guid"].astype(str).str.strip(),
         )
-        with tarfile.open(source_tar_file) as file:
-            file.extractall(path=f"{target_root_path}/{target_unpack_folder}")
-        add_id_column(
-            source_json_file=source_json_file,
-            destination_json_file=destination_json_file,
-            guid=guid,
+    )
+    max_workers = min(8, (os.cpu_count() or 1) * 4)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(
+                process_source_file,
+                project_id=project_id,
+                gcs_source_file=gcs_source_file,
+                guid=guid,
+                target_gcs_bucket=target_gcs_bucket,
+                target_gcs_path=target_gcs_path,
+                target_root_path=target_root_path,
+                target_unpack_folder=target_unpack_folder,
+                target_load_folder=target_load_folder,
+            )
+            for gcs_source_file, guid in path_to_guid.items()
+        ]
+        for future in as_completed(futures):
+            if future.exception() is not None:
+                # Don't start the rest of the batch; retry reruns it anyway
+                for pending in futures:
+                    pending.cancel()
+                raise future.exception()
+    os.unlink(batch_filename)
+
+
+def process_source_file(
+    project_id: str,
+    gcs_source_file: str,
+    guid: str,
+    target_gcs_bucket: str,
+    target_gcs_path: str,
+    target_root_path: str,
+    target_unpack_folder: str,
+    target_load_folder: str,
+) -> None:
+    source_json_file = f"{target_root_path}/{target_unpack_folder}/{guid}/out.log"
+    destination_json_file = f"{target_root_path}/{target_load_folder}/out{guid}.log"
+    source_blob = storage.Blob.from_string(
+        gcs_source_file, client=get_storage_client(project_id)
+    )
+    with source_blob.open("rb") as source_stream:
+        extract_tar_gz_stream(
+            source_stream=source_stream,
+            destination_folder=f"{target_root_path}/{target_unpack_folder}",
         )
-        upload_file_to_gcs(
-            file_path=destination_json_file,
-            gcs_bucket=target_gcs_bucket,
-            gcs_path=f"{target_gcs_path}/{target_load_folder}/out{guid}.log",
+    add_id_column(
+        source_json_file=source_json_file,
+        destination_json_file=destination_json_file,
+        guid=guid,
+    )
+    upload_file_to_gcs(
+        file_path=destination_json_file,
+        gcs_bucket=target_gcs_bucket,
+        gcs_path=f"{target_gcs_path}/{target_load_folder}/out{guid}.log",
+    )
+    os.unlink(destination_json_file)
+    shutil.rmtree(f"{target_root_path}/{target_unpack_folder}/{guid}")
+
+
+def extract_tar_gz_stream(
+    source_stream: io.BufferedIOBase, destination_folder: str
+) -> None:
+    pigz = shutil.which("pigz")
+    if not pigz:
+        with tarfile.open(fileobj=source_stream, mode="r|gz") as file:
+            file.extractall(path=destination_folder)
+        return
+    # Decompress with pigz in a child process while a thread feeds it the stream
+    feeder_errors = []
+    with subprocess.Popen(
+        [pigz, "-dc"], stdin=subprocess.PIPE, stdout=subprocess.PIPE
+    ) as process:
+        feeder = threading.Thread(
+            target=copy_stream_and_close,
+            args=(source_stream, process.stdin, feeder_errors),
         )
-        os.unlink(source_tar_file)
-        os.unlink(destination_json_file)
-        shutil.rmtree(f"{target_root_path}/{target_unpack_folder}/{guid}")
-        os.unlink(batch_filename)
+        feeder.start()
+        try:
+            with tarfile.open(fileobj=process.stdout, mode="r|") as file:
+                file.extractall(path=destination_folder)
+            while process.stdout.read(1 << 20):
+                pass
+        except BaseException:
+            # Stop pigz so a feeder blocked on a full pipe can finish
+            process.kill()
+            raise
+        finally:
+            feeder.join()
+            # A broken pipe only means pigz stopped reading; report real read errors
+            if feeder_errors and not isinstance(feeder_errors[0], BrokenPipeError):
+                raise feeder_errors[0]
+    if feeder_errors:
+        raise feeder_errors[0]
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, process.args)
+
+
+def copy_stream_and_close(
+    source: io.BufferedIOBase, destination: io.BufferedIOBase, errors: list
+) -> None:
+    try:
+        with destination:
+            shutil.copyfileobj(source, destination, 1 << 20)
+    except BaseException as error:
+        errors.append(error)
 
 
 def generate_folder_hierarchy(
@@ -233,68 +354,75 @@ def generate_batch_metadata_files(
     file_type: str,
 ) -> None:
     logging.info("Collecting list of files to process ...")
-    storage_client = storage.Client(project_id)
+    storage_client = get_storage_client(project_id)
     bucket_name = str.split(source_gcs_folder_path, "gs://")[1].split("/")[0]
     bucket = storage_client.bucket(bucket_name)
-    df_filelist = pd.DataFrame(columns=["pathname", "guid", "batchnumber"])
-    total_number_files_in_bucket = count_files_in_gcs_bucket(
-        project_id=project_id,
-        source_gcs_folder_path=source_gcs_folder_path,
-        file_type=".tar.gz",
-    )
+    rows = []
+    metadata_filenames = []
     file_counter = 0
     batch_number = 0
     prefix_folder = source_gcs_folder_path.replace("gs://", "").replace(
         f"{bucket_name}/", ""
     )
-    for blob in bucket.list_blobs(prefix=prefix_folder):
-        filename = str(blob).split(",")[1].strip()
-        batch_number_zfill = str(batch_number).zfill(6)
-        batch_metadata_file_path = f"{target_root_path}/{target_batch_folder}/batch_metadata-{batch_number_zfill}.txt"
-        if filename.find(f"{file_type}") > 0 or file_type == "":
-            filenm = os.path.basename(filename)
-            path = f"{source_gcs_folder_path}/{filenm}"
-            guid = str(filenm).replace(f"{file_type}", "")
-            if (
-                file_counter % int(source_file_batch_length) == 0
-                or file_counter == total_number_files_in_bucket
-            ):
-                if batch_number > 0:
-                    save_to_new_file(
-                        df=df_filelist, file_path=batch_metadata_file_path, sep="|"
-                    )
-                    metadata_filename = os.path.basename(batch_metadata_file_path)
-                    upload_file_to_gcs(
-                        file_path=batch_metadata_file_path,
-                        gcs_bucket=target_gcs_bucket,
-                        gcs_path=f"{target_root_path}/{target_batch_folder}/{metadata_filename}",
+    for blob in bucket.list_blobs(
+        prefix=prefix_folder, match_glob=f"**{file_type}" if file_type else None
+    ):
+        filenm = os.path.basename(blob.name)
+        path = f"{source_gcs_folder_path}/{filenm}"
+        guid = str(filenm).replace(f"{file_type}", "")
+        if file_counter % int(source_file_batch_length) == 0:
+            if rows:
+                metadata_filenames.append(
+                    save_batch_metadata_file(
+                        rows=rows,
+                        batch_number=batch_number,
+                        target_root_path=target_root_path,
+                        target_batch_folder=target_batch_folder,
                     )
-                df_filelist = pd.DataFrame(columns=["pathname", "guid", "batchnumber"])
-                batch_number += 1
-                logging.info(
-                    f"Generating metadata for batch {batch_number} file #{file_counter}"
                 )
-            df_filelist.loc[len(df_filelist)] = [path, guid, batch_number]
-            file_counter += 1
-
-
-def save_to_new_file(df: pd.DataFrame, file_path: str, sep: str = "|") -> None:
-    logging.info(f"Saving data to target file.. {file_path} ...")
-    df.to_csv(file_path, index=False, sep=sep)
+            rows = []
+            batch_number += 1
+            logging.info(
+                f"Generating metadata for batch {batch_number} file #{file_counter}"
+            )
+        rows.append((path, guid, batch_number))
+        file_counter += 1
+    if rows:
+        metadata_filenames.append(
+            save_batch_metadata_file(
+                rows=rows,
+                batch_number=batch_number,
+                target_root_path=target_root_path,
+                target_batch_folder=target_batch_folder,
+            )
+        )
+    logging.info(f"Uploading {len(metadata_filenames)} batch metadata files")
+    transfer_manager.upload_many_from_filenames(
+        storage_client.bucket(target_gcs_bucket),
+        metadata_filenames,
+        source_directory=f"{target_root_path}/{target_batch_folder}",
+        blob_name_prefix=f"{target_root_path}/{target_batch_folder}/",
+        worker_type=transfer_manager.THREAD,
+        max_workers=8,
+        raise_exception=True,
+    )
 
 
-def count_files_in_gcs_bucket(
-    project_id: str, source_gcs_folder_path: str, file_type: str
-) -> int:
-    storage_client = storage.Client(project_id)
-    bucket_name = str.split(source_gcs_folder_path, "gs://")[1].split("/")[0]
-    bucket = storage_client.bucket(bucket_name)
-    cnt_files = 0
-    for blob in bucket.list_blobs():
-        filename = str(blob).split(",")[1].strip()
-        if os.path.basename(filename).find(f"{file_type}") > 0 or file_type == "":
-            cnt_files += 1
-    return cnt_files
+def save_batch_metadata_file(
+    rows: list,
+    batch_number: int,
+    target_root_path: str,
+    target_batch_folder: str,
+) -> str:
+    batch_number_zfill = str(batch_number).zfill(6)
+    metadata_filename = f"batch_metadata-{batch_number_zfill}.parquet"
+    batch_metadata_file_path = (
+        f"{target_root_path}/{target_batch_folder}/{metadata_filename}"
+    )
+    df_filelist = pd.DataFrame(rows, columns=["pathname", "guid", "batchnumber"])
+    logging.info(f"Saving batch metadata file {batch_metadata_file_path} ...")
+    df_filelist.to_parquet(batch_metadata_file_path, compression="zstd", index=False)
+    return metadata_filename
 
 
 def download_file_gcs(
@@ -302,7 +430,7 @@ def download_file_gcs(
 ) -> None:
     object_name = os.path.basename(source_location)
     dest_object = f"{destination_folder}/{object_name}"
-    storage_client = storage.Client(project_id)
+    storage_client = get_storage_client(project_id)
     bucket_name = str.split(source_location, "gs://")[1].split("/")[0]
     bucket = storage_client.bucket(bucket_name)
     source_object_path = str.split(source_location, f"gs://{bucket_name}/")[1]
@@ -310,21 +438,37 @@ def download_file_gcs(
     blob.download_to_filename(dest_object)
 
 
-def add_id_column(source_json_file: str, destination_json_file: str, guid: str):
-    shutil.copyfile(source_json_file, destination_json_file)
-    cmd = (
-        f'sed -i -e \'s/{{\\"frame\\"/{{"id": \\"{guid}\\", \\"frame\\"/g\'{destination_json_file}'
-        # 'sed -i -e \'s/{\\"frame\\"/{"id": "'
-        # + guid
-        # + '"\, "frame"/g\' '
-        # + destination_json_file
-    )
-    logging.info(f"cmd = {cmd}")
-    subprocess.check_call([cmd], shell=True)
+def add_id_column(
+    source_json_file: str,
+    destination_json_file: str,
+    guid: str,
+    chunk_size: int = 1 << 20,
+) -> None:
+    logging.info(f"Adding id {guid} to {destination_json_file}")
+    search = b'{"frame"'
+    replace = f'{{"id": "{guid}", "frame"'.encode()
+    with open(source_json_file, "rb") as source, open(
+        destination_json_file, "wb"
+    ) as destination:
+        carry = b""
+        for chunk in iter(lambda: source.read(chunk_size), b""):
+            buffer = carry + chunk
+            # Hold back a trailing "{" that may begin a match split across chunks
+            cut = buffer.rfind(b"{", max(len(buffer) - len(search) + 1, 0))
+            if cut == -1:
+                cut = len(buffer)
+            destination.write(buffer[:cut].replace(search, replace))
+            carry = buffer[cut:]
+        destination.write(carry.replace(search, replace))
+
+
+@functools.lru_cache(maxsize=None)
+def get_storage_client(project_id: str = "") -> storage.Client:
+    return storage.Client(project_id) if project_id else storage.Client()
 
 
 def upload_file_to_gcs(file_path: pathlib.Path, gcs_bucket: str, gcs_path: str) -> None:
-    storage_client = storage.Client()
+    storage_client = get_storage_client()
     bucket = storage_client.bucket(gcs_bucket)
     blob = bucket.blob(gcs_path)
     blob.upload_from_filename(file_path)
@@ -333,7 +477,7 @@ def upload_file_to_gcs(file_path: pathlib.Path, gcs_bucket: str, gcs_path: str)
 def remove_gcs_path(gcs_bucket: str, gcs_path: str) -> None:
     drop_path = os.path.split(gcs_path)[0]
     logging.info(f"Removing files from GCS path {drop_path}")
-    storage_client = storage.Client()
+    storage_client = get_storage_client()
     bucket = storage_client.bucket(gcs_bucket)
     bucket.delete_blobs(blobs=list(bucket.list_blobs(prefix=f"{drop_path}/")))
 